@@ -1,19 +1,26 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import difflib
-from filecmp import dircmp
-from fnmatch import filter
-from itertools import product
+import errno
+from fnmatch import translate
+from functools import lru_cache
+import hashlib
 import logging
 import os
 from pathlib import Path, PurePath
-import random
-from shutil import copy, copyfile, copytree, ignore_patterns, rmtree
-import string
+import pickle
+import re
+import secrets
+from shutil import copy, copy2, copyfile, copystat, copytree, ignore_patterns, rmtree
+from stat import S_IFDIR, S_IFMT
 import sys
 
 import colorama
 from graphviz import Digraph
 
+colorama.init(autoreset=True)
+
 
 class NoWitFolderFoundError(Exception):
     pass
@@ -47,6 +54,10 @@ class BranchExistsError(Exception):
     pass
 
 
+class InvalidBranchNameError(Exception):
+    pass
+
+
 class InvalidMergeError(Exception):
     pass
 
@@ -61,29 +72,38 @@ logger.setLevel(logging.DEBUG)
 LOG_FORMAT = "%(levelname)s  %(asctime)s - %(message)s"
 formatter = logging.Formatter(LOG_FORMAT, datefmt="%Y-%m-%d %H:%M:%S")
 
-file_handler = logging.FileHandler(Path(__file__).parent / 'wit.log')
+# delay=True defers opening wit.log until the first record is emitted.
+file_handler = logging.FileHandler(Path(__file__).parent / 'wit.log', delay=True)
 file_handler.setLevel(logging.DEBUG)
 file_handler.setFormatter(formatter)
+file_handler.set_name('wit.file')
 
 stream_handler = logging.StreamHandler(sys.stdout)
 stream_handler.setLevel(logging.INFO)
+stream_handler.set_name('wit.stream')
 
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+# Skip only wit's own handlers, so a re-import doesn't duplicate output but
+# a root logger configured elsewhere (e.g. basicConfig) still gets them.
+installed = {handler.get_name() for handler in logger.handlers}
+for handler in (file_handler, stream_handler):
+    if handler.get_name() not in installed:
+        logger.addHandler(handler)
 
 
 def init(path=None):
     if path is None:
         path = os.getcwd()
-    folders_to_create = ('.wit', Path('.wit', 'images'),
-                         Path('.wit', 'staging_area'))
+    wit_folder = Path(path, '.wit')
+    folders_to_create = (wit_folder, wit_folder / 'images',
+                         wit_folder / 'staging_area')
     exists = False
     for folder in folders_to_create:
         if not os.path.exists(folder):
             os.mkdir(folder)
         else:
             exists = True
-    Path('.wit', 'activated.txt').write_text('master')
+    Path(wit_folder, 'activated.txt').write_text('master')
+    _find_wit_from.cache_clear()
     if not exists:
         logger.info(f'Wit repository initialized in {path}')
     else:
@@ -147,16 +167,15 @@ def evaluate_args():
 
 
 def find_wit():
-    path = Path.cwd()
-    found_wit = False
-    if Path('.wit').exists():
-        found_wit = True
-        return path
-    while not found_wit and path != path.parent:
-        path = path.parent
-        os.chdir(path)
-        if Path('.wit').exists():
-            found_wit = True
+    return _find_wit_from(Path.cwd())
+
+
+# Keyed by the working directory so changing directories in-process still
+# finds the right repository; failed lookups raise and aren't cached.
+@lru_cache(maxsize=None)
+def _find_wit_from(cwd):
+    for path in (cwd, *cwd.parents):
+        if (path / '.wit').exists():
             return path
     raise NoWitFolderFoundError(
         'No .wit folder found, unable to process request.\n'
@@ -166,12 +185,17 @@ def find_wit():
 
 def add(path_to_add):
     wit_root = find_wit()
-    dst = PurePath(wit_root, '.wit', 'staging_area', path_to_add)
+    # abspath rather than resolve() so a symlink pointing outside the
+    # repository is staged as the link's own path.
+    rel_path = Path(os.path.abspath(path_to_add)).relative_to(wit_root)
+    dst = PurePath(wit_root, '.wit', 'staging_area', rel_path)
     try:
-        copytree(path_to_add, dst)
+        with MultithreadedCopier() as copier:
+            copytree(path_to_add, dst, copy_function=copier.copy)
     except NotADirectoryError:
         if not os.path.exists(dst.parent):
             os.makedirs(dst.parent)
+        unlink_staged(dst)
         copy(path_to_add, dst)
     except FileExistsError:
         if not os.path.exists(dst.parent):
@@ -185,13 +209,17 @@ def commit(message, second_parent_for_merge=None):
     wit_images_commit_id = Path(wit_root, '.wit', 'images', commit_id)
     wit_staging = Path(wit_root, '.wit', 'staging_area')
     changes_to_be_committed = get_changes_to_be_committed(
-        wit_root, get_head_commit())
+        wit_root, get_head_commit(wit_root))
     if not changes_to_be_committed:
         raise NoChangesSinceLastCommitError(
             'Nothing to commit, no changes since commit.')
-    copytree(wit_staging, Path(wit_images_commit_id))
-    gen_commit_txt(commit_id, message, second_parent_for_merge)
-    gen_references(commit_id)
+    snapshot_tree(wit_staging, wit_images_commit_id)
+    append_parent_index(wit_root, commit_id, get_head_commit(wit_root),
+                        second_parent_for_merge)
+    gen_commit_txt(commit_id, message, second_parent_for_merge, wit_root)
+    load_commit_graph.cache_clear()
+    gen_references(commit_id, wit_root)
+    flush_refs(wit_root)
     logger.info(f'Committed successfully commit id: {commit_id}')
 
     return commit_id
@@ -199,12 +227,15 @@ def commit(message, second_parent_for_merge=None):
 
 def get_status(wit_root, references=None):
     if references is None:
-        references = read_references()
-    changes_to_be_committed = get_changes_to_be_committed(
-        wit_root, references['HEAD']
-    )
-    changes_not_staged = get_changes_not_staged(wit_root)
-    untracked = get_untracked(wit_root)
+        references = read_references(wit_root)
+    staging_area = Path(wit_root, '.wit', 'staging_area')
+    last_commit_folder = Path(wit_root, '.wit', 'images', references['HEAD'])
+    walk = list(walk_three(os.fspath(wit_root), os.fspath(staging_area),
+                           os.fspath(last_commit_folder)))
+    changes_to_be_committed = list(filter_changes_to_be_committed(wit_root, walk))
+    changes_not_staged = list(filter_changes_not_staged(wit_root, walk))
+    untracked = list(filter_untracked(walk))
+    save_index(wit_root)
 
     return {'changes_to_be_committed': changes_to_be_committed,
             'changes_not_staged': changes_not_staged,
@@ -213,7 +244,7 @@ def get_status(wit_root, references=None):
 
 def status():
     wit_root = find_wit()
-    ref = read_references()
+    ref = read_references(wit_root)
     if ref:
         current_status = get_status(wit_root, ref)
         message = (
@@ -233,30 +264,26 @@ def checkout(commit_id):
     branch_name = ''
     if len(commit_id) != 40:
         branch_name = commit_id
-        commit_id = find_commit_by_branch_name(branch_name)
+        commit_id = find_commit_by_branch_name(branch_name, wit_root)
     commit_id_exists = find_commit_by_id(wit_root, commit_id)
     if not (commit_id_exists):
         raise NonExistentCommitIdError('The commit ID given does not exist.')
 
-    current_status = get_status(wit_root)
-    changes_to_be_committed = current_status['changes_to_be_committed']
-    changes_not_staged = current_status['changes_not_staged']
-    untracked = current_status['untracked']
-
-    status_ok = not (changes_to_be_committed or changes_not_staged)
-    if not status_ok:
+    untracked = get_untracked_if_clean(wit_root, get_head_commit(wit_root))
+    if untracked is None:
         raise UnableToCheckoutError(
             'You cannot checkout with files to be committed or changes not staged for commit.'
         )
     logger.info(f'wit restoring commit: {commit_id}')
     path_to_copy = Path(wit_root, '.wit', 'images', f'{commit_id}')
-    copytree(path_to_copy, wit_root, ignore=ignore_patterns(
-        *untracked, '.wit'), dirs_exist_ok=True)
+    with MultithreadedCopier() as copier:
+        copytree(path_to_copy, wit_root, ignore=ignore_patterns(
+            *untracked, '.wit'), copy_function=copier.copy, dirs_exist_ok=True)
     staging_area = Path(wit_root, '.wit', 'staging_area')
     rmtree(staging_area)
-    staging_area.mkdir()
-    copytree(path_to_copy, staging_area, dirs_exist_ok=True)
-    edit_references('HEAD', commit_id)
+    snapshot_tree(path_to_copy, staging_area)
+    edit_references('HEAD', commit_id, wit_root)
+    flush_refs(wit_root)
 
     activated_text = f'{branch_name}'
     Path(wit_root, '.wit', 'activated.txt').write_text(activated_text)
@@ -268,126 +295,235 @@ def get_two_line_id(commit_id):
     second_half = commit_id[20:]
     return f'{first_half}\n{second_half}'
 
-def draw_graph(commit_list):
-    dot = Digraph(name='.wit/witgraph', comment='Wit Graph', format="png",
+
+def draw_graph(commits, edges, wit_root):
+    dot = Digraph(name='witgraph', directory=Path(wit_root, '.wit'),
+                  comment='Wit Graph', format="png",
                   node_attr={'color': 'lightblue', 'style': 'filled', 'shape': 'circle'})
-    for i in range(len(commit_list) - 1):
-        if isinstance(commit_list[i], list):
-            parent_a, parent_b = commit_list[i]
-            if not isinstance(commit_list[i + 1], list):
-                dot.edge(get_two_line_id(parent_a), get_two_line_id(commit_list[i + 1]))
-                dot.edge(get_two_line_id(parent_b), get_two_line_id(commit_list[i + 1]))
-        else:
-            dot.edge(get_two_line_id(commit_list[i]), get_two_line_id(commit_list[i + 1]))
+    two_line_ids = {commit_id: get_two_line_id(commit_id) for commit_id in commits}
+    for two_line_id in two_line_ids.values():
+        dot.node(two_line_id)
+    for parent, child in edges:
+        dot.edge(two_line_ids[parent], two_line_ids[child])
 
     dot.view()
 
 
 def graph():
     wit_root = find_wit()
-    ref = read_references()
+    ref = read_references(wit_root)
     if ref:
         head_id = ref['HEAD']
-        commits = list(get_all_parent_commits(
-            wit_root, head_id))[::-1]
-        draw_graph(commits)
+        commits = sorted(ancestors(wit_root, head_id))
+        edges = [(parent, commit_id) for commit_id in commits
+                 for parent in get_parent_ids(wit_root, commit_id)]
+        draw_graph(commits, edges, wit_root)
     else:
         raise NoPreviousCommitsError(
             'No previous commits have ever been taken.')
 
 
 def branch(branch_name):
+    if not branch_name or '=' in branch_name or '\n' in branch_name:
+        raise InvalidBranchNameError(
+            "Branch names must be non-empty and can't contain '=' or newlines.")
     wit_root = find_wit()
-    ref = read_references()
+    ref = read_references(wit_root)
     if branch_name not in ref:
-        text_to_add = f'{branch_name}={ref["HEAD"]}'
-        with Path(wit_root, '.wit', 'references.txt').open('a') as fh:
-            fh.write(text_to_add)
+        edit_references(branch_name, ref['HEAD'], wit_root)
+        flush_refs(wit_root)
     else:
         raise BranchExistsError(
             'Branch name exists, cannot create branch with this name.')
 
 
 # Based on https://stackoverflow.com/questions/42487578/python-shutil-copytree-use-ignore-function-to-keep-specific-files-types
+@lru_cache(maxsize=None)
+def compile_patterns(patterns):
+    # (?!) never matches, so an empty pattern list keeps nothing.
+    return re.compile('|'.join(translate(pattern) for pattern in patterns) or '(?!)')
+
+
 def include_patterns(*patterns):
+    combined = compile_patterns(patterns)
+
     def _ignore_patterns(path, names):
-        keep = {name for pattern in patterns
-                for name in filter(names, pattern)}
         ignore = {name for name in names
-                  if name not in keep and not Path(path, name).is_dir()}
+                  if not combined.match(name) and not os.path.isdir(os.path.join(path, name))}
         return ignore
     return _ignore_patterns
 
 
+# Snapshots hardlink their files instead of copying them, so anything that
+# writes into the staging area must replace files rather than overwrite them
+# in place, or it would rewrite the committed images as well.
+def snapshot_tree(src, dst):
+    os.mkdir(dst)
+    with os.scandir(src) as it:
+        for entry in it:
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                snapshot_tree(entry.path, target)
+                continue
+            try:
+                os.link(entry.path, target)
+            except OSError as err:
+                # Hard links can fail across devices, past the link limit or
+                # on filesystems without them (vfat, exFAT, SMB, some FUSE).
+                if err.errno == errno.EXDEV:
+                    copy2(entry.path, target)
+                else:
+                    copy_file_range_or_copy2(entry.path, target)
+
+
+def copy_file_range_or_copy2(src, dst):
+    # Only reached when src and dst share a filesystem, where copy_file_range
+    # copies inside the kernel (or shares extents on btrfs/xfs). Cross-device
+    # copies go straight to copy2, which already uses sendfile.
+    if not hasattr(os, 'copy_file_range'):
+        return copy2(src, dst)
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        if remaining > 0:
+            raise OSError(errno.EIO, 'copy_file_range stopped early', src)
+    except OSError:
+        return copy2(src, dst)
+    copystat(src, dst)
+    return dst
+
+
+# Used as copytree's copy_function so file copies run on a thread pool while
+# copytree keeps walking; copy errors are raised when the block exits.
+class MultithreadedCopier(ThreadPoolExecutor):
+    def __init__(self, copy_function=copy2, max_workers=8):
+        super().__init__(max_workers=max_workers)
+        self.copy_function = copy_function
+        self.futures = []
+
+    def copy(self, src, dst):
+        self.futures.append(self.submit(self.copy_function, src, dst))
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super().__exit__(exc_type, exc_val, exc_tb)
+        if exc_type is None:
+            for future in self.futures:
+                future.result()
+        return False
+
+
+def unlink_staged(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def copy_unlinked(src, dst):
+    unlink_staged(dst)
+    return copy2(src, dst)
+
+
 def merge(branch_to_merge):
     wit_root = find_wit()
     current_branch = get_activated_branch(wit_root)
-    commit_a, commit_b = find_commit_by_branch_name(
-        current_branch), find_commit_by_branch_name(branch_to_merge)
+    commit_a = find_commit_by_branch_name(current_branch, wit_root)
+    commit_b = find_commit_by_branch_name(branch_to_merge, wit_root)
     if commit_a == commit_b:
         raise InvalidMergeError('Branches are already on the same commit.')
 
-    common_parent = get_common_parent(commit_a, commit_b)
+    common_parent = get_common_parent(commit_a, commit_b, wit_root)
     staging_area = Path(wit_root, '.wit', 'staging_area')
     images_folder = Path(wit_root, '.wit', 'images')
 
-    dcmp1 = dircmp(Path(images_folder, common_parent),
-                   Path(images_folder, commit_b))
-    dcmp2 = dircmp(staging_area, Path(images_folder, commit_a))
-    changes_branch_to_merge_with_parent = list(
-        get_changes(dcmp1, left_only=False, right_only=True))
-    changes_active_branch_with_staging = list(
-        get_changes(dcmp2, left_only=True, right_only=True))
+    # Subtree hashes are shared between both comparisons, and the staging
+    # check runs first so a rejected merge never walks the branch images.
+    memo = {}
+    changes_active_branch_with_staging = any(diff_trees(
+        wit_root, staging_area, Path(images_folder, commit_a),
+        left_only=True, right_only=True, memo=memo))
     if changes_active_branch_with_staging:
+        save_index(wit_root)
         raise InvalidMergeError(
             'Merging is not possible due to file differences.')
-    copytree(Path(images_folder, commit_b), staging_area, ignore=include_patterns(
-        *changes_branch_to_merge_with_parent), dirs_exist_ok=True)
+    changes_branch_to_merge_with_parent = list(diff_trees(
+        wit_root, Path(images_folder, common_parent),
+        Path(images_folder, commit_b), left_only=False, right_only=True,
+        memo=memo))
+    save_index(wit_root)
+    with MultithreadedCopier(copy_unlinked) as copier:
+        copytree(Path(images_folder, commit_b), staging_area, ignore=include_patterns(
+            *changes_branch_to_merge_with_parent), copy_function=copier.copy,
+            dirs_exist_ok=True)
     commit(
         f'MERGED {current_branch} with {branch_to_merge}!', second_parent_for_merge=commit_b)
 
 
+def locate_diff_arg(arg, wit_root):
+    # Paths are taken relative to the working directory first, then to the
+    # repository root (where wit used to chdir). Anything else is left as a
+    # branch name or commit id.
+    if arg is None:
+        return None
+    for base in (os.getcwd(), wit_root):
+        path = os.path.join(base, arg)
+        if os.path.exists(path):
+            return os.path.abspath(path)
+    return arg
+
+
 def diff(cached=False, arg_a=None, arg_b=None):
     wit_root = find_wit()
     staging_area = Path(wit_root, '.wit/staging_area')
+    arg_a = locate_diff_arg(arg_a, wit_root)
+    arg_b = locate_diff_arg(arg_b, wit_root)
     if cached:
         if arg_a is None and arg_b is None:
-            head_id = get_head_commit()
+            head_id = get_head_commit(wit_root)
             head_dir = get_dir_from_branch_or_commit_id(head_id, wit_root)
-            diff_two_dirs(staging_area, head_dir)
+            diff_two_dirs(staging_area, head_dir, wit_root)
         elif arg_a and arg_b is None:
-            head_id = get_head_commit()
+            head_id = get_head_commit(wit_root)
             head_dir = get_dir_from_branch_or_commit_id(head_id, wit_root)
             if Path(arg_a).is_file():
-                diff_file_in_dirs(staging_area, head_dir, arg_a)
+                diff_file_in_dirs(staging_area, head_dir,
+                                  os.path.relpath(arg_a, wit_root), wit_root)
             else:
-                diff_two_dirs(staging_area, arg_a)
+                diff_two_dirs(staging_area, arg_a, wit_root)
         elif not Path(arg_a).is_file() and Path(arg_b).is_file():
-            diff_file_in_dirs(staging_area, arg_a, arg_b)
+            diff_file_in_dirs(staging_area, arg_a,
+                              os.path.relpath(arg_b, wit_root), wit_root)
         elif Path(arg_a).is_file() and Path(arg_b).is_file():
             diff_two_files(arg_a, arg_b)
     else:
         if arg_a is None and arg_b is None:
-            diff_two_dirs(wit_root, staging_area)
+            diff_two_dirs(wit_root, staging_area, wit_root)
         elif arg_a and arg_b is None:
             if Path(arg_a).is_file():
-                diff_file_in_dirs(wit_root, staging_area, arg_a)
+                diff_file_in_dirs(wit_root, staging_area,
+                                  os.path.relpath(arg_a, wit_root), wit_root)
             else:
-                diff_two_dirs(wit_root, arg_a)
+                diff_two_dirs(wit_root, arg_a, wit_root)
 
         elif not Path(arg_a).is_file() and Path(arg_b).is_file():
-            diff_file_in_dirs(wit_root, arg_a, arg_b)
+            diff_file_in_dirs(wit_root, arg_a,
+                              os.path.relpath(arg_b, wit_root), wit_root)
         elif Path(arg_a).is_file() and Path(arg_b).is_file():
             diff_two_files(arg_a, arg_b)
         else:
-            diff_two_dirs(arg_a, arg_b)
+            diff_two_dirs(arg_a, arg_b, wit_root)
 
 
 def get_dir_from_branch_or_commit_id(branch_or_commit, wit_root=None):
     commit_id = ''
     if wit_root is None:
         wit_root = find_wit()
-    commit_id_by_branch = find_commit_by_branch_name(branch_or_commit)
+    commit_id_by_branch = find_commit_by_branch_name(branch_or_commit, wit_root)
     if commit_id_by_branch:
         commit_id = commit_id_by_branch
 
@@ -399,8 +535,9 @@ def get_dir_from_branch_or_commit_id(branch_or_commit, wit_root=None):
     return Path(branch_or_commit)
 
 
-def diff_file_in_dirs(arg_a, arg_b, file):
-    wit_root = find_wit()
+def diff_file_in_dirs(arg_a, arg_b, file, wit_root=None):
+    if wit_root is None:
+        wit_root = find_wit()
     dir_a = get_dir_from_branch_or_commit_id(arg_a, wit_root)
     dir_b = get_dir_from_branch_or_commit_id(arg_b, wit_root)
     try:
@@ -410,8 +547,9 @@ def diff_file_in_dirs(arg_a, arg_b, file):
         logger.warning("File doesn't exist in one of the folders.")
 
 
-def diff_two_dirs(arg_a, arg_b):
-    wit_root = find_wit()
+def diff_two_dirs(arg_a, arg_b, wit_root=None):
+    if wit_root is None:
+        wit_root = find_wit()
     dir_a = get_dir_from_branch_or_commit_id(arg_a, wit_root)
     dir_b = get_dir_from_branch_or_commit_id(arg_b, wit_root)
     if not (Path(dir_a).exists() and Path(dir_b).exists()):
@@ -419,52 +557,126 @@ def diff_two_dirs(arg_a, arg_b):
             'Unable to use those diff arguments, try other ones.')
     left_only = []
     right_only = []
-    for root, _dirs, files in os.walk(dir_a):
-        if '.wit' in _dirs:
-            _dirs.remove('.wit')
-        partial_root = Path(root).relative_to(dir_a)
-        dcmp1 = dircmp(Path(dir_b, partial_root), Path(root), ignore=['.wit'])
-        left_only.extend(Path(dir_b, partial_root, f) for f in dcmp1.left_only)
-        right_only.extend(Path(root, f) for f in dcmp1.right_only)
-        for file in files:
-            rel_path = Path(root, file).relative_to(dir_a)
-            if Path(dir_b, rel_path).is_file():
-                diff_two_files(str(Path(dir_a, rel_path)),
-                               str(Path(dir_b, rel_path)))
-    for f in left_only:
-        for line in Path(f).read_text().splitlines():
-            print(colorama.Fore.GREEN + '+' + line)
-    for f in right_only:
-        for line in Path(f).read_text().splitlines():
-            print(colorama.Fore.RED + '-' + line)
+    stack = [(os.fspath(dir_a), os.fspath(dir_b))]
+    while stack:
+        root_a, root_b = stack.pop()
+        entries_a, entries_b = _scan(root_a), _scan(root_b)
+        left_only.extend(entries_b[name] for name in sorted(entries_b.keys() - entries_a.keys()))
+        right_only.extend(entries_a[name] for name in sorted(entries_a.keys() - entries_b.keys()))
+        subdirs = []
+        for name in sorted(entries_a.keys() & entries_b.keys()):
+            entry_a, entry_b = entries_a[name], entries_b[name]
+            if entry_a.is_dir(follow_symlinks=False) and entry_b.is_dir(follow_symlinks=False):
+                subdirs.append((entry_a.path, entry_b.path))
+            elif entry_a.is_file(follow_symlinks=False) and entry_b.is_file(follow_symlinks=False):
+                diff_two_files(entry_a.path, entry_b.path)
+        stack.extend(reversed(subdirs))
+    print_whole_files(iter_entry_files(left_only), '+')
+    print_whole_files(iter_entry_files(right_only), '-')
+
+
+def iter_entry_files(entries):
+    # Entries found on one side only may be whole directories.
+    stack = list(reversed(entries))
+    while stack:
+        entry = stack.pop()
+        if entry.is_dir(follow_symlinks=False):
+            stack.extend(sorted(_scan(entry.path).values(),
+                                key=lambda e: e.name, reverse=True))
+        elif entry.is_file(follow_symlinks=False):
+            yield entry.path
+
+
+BINARY_SNIFF_SIZE = 4096
+DIFF_CONTEXT = 3
+
+
+def is_binary(path):
+    with open(path, 'rb') as fh:
+        return b'\0' in fh.read(BINARY_SNIFF_SIZE)
 
 
 def diff_two_files(file_a_path, file_b_path):
+    stat_a, stat_b = os.stat(file_a_path), os.stat(file_b_path)
+    if stat_a.st_size == stat_b.st_size and stat_a.st_mtime_ns == stat_b.st_mtime_ns:
+        return
+    if is_binary(file_a_path) or is_binary(file_b_path):
+        if (stat_a.st_size == stat_b.st_size
+                and Path(file_a_path).read_bytes() == Path(file_b_path).read_bytes()):
+            return
+        sys.stdout.write(f'Binary files {file_a_path} and {file_b_path} differ\n')
+        return
     file_a_text = Path(file_a_path).read_text().splitlines()
     file_b_text = Path(file_b_path).read_text().splitlines()
 
+    # Strip the common head and tail (keeping enough context lines) so the
+    # matcher only sees the region that changed.
+    shortest = min(len(file_a_text), len(file_b_text))
+    prefix = 0
+    while prefix < shortest and file_a_text[prefix] == file_b_text[prefix]:
+        prefix += 1
+    if prefix == len(file_a_text) == len(file_b_text):
+        return
+    suffix = 0
+    while (suffix < shortest - prefix
+           and file_a_text[-1 - suffix] == file_b_text[-1 - suffix]):
+        suffix += 1
+    start = max(prefix - DIFF_CONTEXT, 0)
+    trim_end = max(suffix - DIFF_CONTEXT, 0)
+
     diffs = difflib.unified_diff(
-        file_a_text, file_b_text, fromfile=file_a_path, tofile=file_b_path)
-    print_colored(diffs)
+        file_a_text[start:len(file_a_text) - trim_end],
+        file_b_text[start:len(file_b_text) - trim_end],
+        fromfile=file_a_path, tofile=file_b_path, n=DIFF_CONTEXT)
+    print_colored(offset_hunks(diffs, start))
+
+
+HUNK_RE = re.compile(r'^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@')
+
+
+def offset_hunks(diff, offset):
+    for line in diff:
+        if offset and line.startswith('@@'):
+            line = HUNK_RE.sub(
+                lambda m: (f'@@ -{int(m[1]) + offset}{m[2] or ""} '
+                           f'+{int(m[3]) + offset}{m[4] or ""} @@'),
+                line)
+        yield line
+
+
+DIFF_COLORS = {
+    '+': colorama.Fore.GREEN,
+    '-': colorama.Fore.RED,
+    '@': colorama.Fore.LIGHTBLUE_EX,
+}
+
+
+def color_line(line, color):
+    return f'{color}{line}{colorama.Style.RESET_ALL}\n'
 
 
 def print_colored(diff):
-    colorama.init(autoreset=True)
+    out = []
     for line in diff:
-        if line[0] == '+' and line[0:3] != '+++':
-            print(colorama.Fore.GREEN + line)
-        elif line[0] == '-' and line[0:3] != '---':
-            print(colorama.Fore.RED + line)
-        elif line[0] == '@':
-            print(colorama.Fore.LIGHTBLUE_EX + line)
+        color = DIFF_COLORS.get(line[:1])
+        if color is None or line[:3] in ('+++', '---'):
+            out.append(f'{line}\n')
         else:
-            print(line)
+            out.append(color_line(line, color))
+    sys.stdout.write(''.join(out))
+
+
+def print_whole_files(paths, prefix):
+    color = DIFF_COLORS[prefix]
+    sys.stdout.write(''.join(color_line(prefix + line, color)
+                             for path in paths
+                             for line in Path(path).read_text().splitlines()))
 
 
 def get_head_commit(wit_root=None):
     if wit_root is None:
         wit_root = find_wit()
-    ref = read_references()
+    ref = read_references(wit_root)
     if ref:
         return ref['HEAD']
     else:
@@ -475,11 +687,20 @@ def get_common_parent(commit_a, commit_b, wit_root=None):
     if wit_root is None:
         wit_root = find_wit()
 
-    parents_a = get_all_parent_commits(wit_root, commit_a, flat=True)
-    parents_b = get_all_parent_commits(wit_root, commit_b, flat=True)
-    for a, b in product(parents_a, parents_b):
-        if a == b:
-            return a
+    # Breadth-first from commit_b, so the first commit that is also an
+    # ancestor of commit_a is the nearest common one.
+    ancestors_a = ancestors(wit_root, commit_a)
+    seen = {commit_b}
+    queue = deque([commit_b])
+    while queue:
+        commit_id = queue.popleft()
+        if commit_id in ancestors_a:
+            return commit_id
+        for parent in get_parent_ids(wit_root, commit_id):
+            if parent not in seen:
+                seen.add(parent)
+                queue.append(parent)
+    return None
 
 
 def get_activated_branch(wit_root=None):
@@ -488,55 +709,93 @@ def get_activated_branch(wit_root=None):
     return Path(wit_root, '.wit', 'activated.txt').read_text()
 
 
+KV_RE = re.compile(rb'^([^=\r\n]+)=([^\r\n]*)\r?$', re.M)
+
+
 def txt_to_dict(path):
-    path = Path(path)
-    if os.path.exists(path) and path.is_file():
-        with open(Path(path), 'r') as fh:
-            f_content = fh.read()
-    else:
-        f_content = ''
-    if f_content:
-        data_lists = (line.split('=') for line in f_content.splitlines())
-        return {k: v for k, v in data_lists}
-    else:
+    try:
+        f_content = Path(path).read_bytes()
+    except (FileNotFoundError, IsADirectoryError):
         return {}
+    return {k.decode(): v.decode() for k, v in KV_RE.findall(f_content)}
 
 
-def get_parent_commit(wit_root, commit_id):
-    if not commit_id:
-        return ''
+# .wit/parents.idx holds one fixed-size record per commit: the commit id,
+# its parent and its second (merge) parent as raw 20-byte ids, zero-filled
+# when absent. Commits made before the index existed fall back to their .txt.
+PARENT_INDEX_FILE = 'parents.idx'
+ID_SIZE = 20
+RECORD_SIZE = ID_SIZE * 3
+NULL_ID = bytes(ID_SIZE)
 
-    commit_text_path = Path(wit_root, '.wit', 'images', f'{commit_id}.txt')
-    commit_text_dict = txt_to_dict(commit_text_path)
-    parent = commit_text_dict.get('parent', '')
-    if ',' not in parent:
-        return parent
-    else:
-        return parent.split(',')
 
+def _id_to_bytes(commit_id):
+    if not commit_id or commit_id == 'None':
+        return NULL_ID
+    return bytes.fromhex(commit_id)
 
-def get_all_parent_commits(wit_root, commit_id, flat=False):
-    yield commit_id
-    parent = get_parent_commit(wit_root, commit_id)
-    while parent and parent != 'None':
-        if flat:
-            if isinstance(parent, list):
-                yield parent[0]
-                yield parent[1]
-            else:
-                yield parent
-        else:
-            yield parent
-        parent = get_parent_commit(wit_root, parent)
+
+def append_parent_index(wit_root, commit_id, parent=None, second_parent=None):
+    record = b''.join(_id_to_bytes(c) for c in (commit_id, parent, second_parent))
+    with open(Path(wit_root, '.wit', PARENT_INDEX_FILE), 'ab') as fh:
+        fh.write(record)
+
+
+def load_parent_index(wit_root_str):
+    try:
+        data = Path(wit_root_str, '.wit', PARENT_INDEX_FILE).read_bytes()
+    except FileNotFoundError:
+        return {}
+    index = {}
+    for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        record = data[offset:offset + RECORD_SIZE]
+        ids = [record[i:i + ID_SIZE] for i in range(0, RECORD_SIZE, ID_SIZE)]
+        commit_id, parents = ids[0].hex(), ids[1:]
+        index[commit_id] = tuple(p.hex() for p in parents if p != NULL_ID)
+    return index
+
+
+@lru_cache(maxsize=None)
+def load_commit_graph(wit_root_str):
+    # Maps every commit to its parents: indexed commits come straight from
+    # parents.idx and only older commits have their .txt parsed.
+    commit_graph = {commit_id: list(parents) for commit_id, parents
+                    in load_parent_index(wit_root_str).items()}
+    with os.scandir(Path(wit_root_str, '.wit', 'images')) as it:
+        for entry in it:
+            commit_id, ext = os.path.splitext(entry.name)
+            if ext == '.txt' and commit_id not in commit_graph:
+                parent = txt_to_dict(entry.path).get('parent', '')
+                commit_graph[commit_id] = [p for p in parent.split(',')
+                                           if p and p != 'None']
+    return commit_graph
+
+
+def get_parent_ids(wit_root, commit_id):
+    return load_commit_graph(str(wit_root)).get(commit_id, [])
+
+
+def ancestors(wit_root, commit_id):
+    # One walk over the cached commit graph; commit_id itself is included.
+    found = set()
+    stack = [commit_id]
+    while stack:
+        current = stack.pop()
+        if current in found:
+            continue
+        found.add(current)
+        stack.extend(get_parent_ids(wit_root, current))
+    return found
 
 
 def find_commit_by_id(wit_root, commit_id):
-    images = Path(wit_root, '.wit', 'images')
-    return commit_id in os.listdir(images)
+    if not commit_id:
+        return False
+    return Path(wit_root, '.wit', 'images', commit_id).is_dir()
 
 
-def find_commit_by_branch_name(branch_name):
-    ref = read_references()
+def find_commit_by_branch_name(branch_name, wit_root=None):
+    ref = read_references(wit_root)
     if ref:
         commit_id = ref.get(branch_name)
         return commit_id
@@ -547,10 +806,12 @@ def gen_timestamp():
     return datetime.now(timezone(timedelta(hours=3))).strftime("%a %b %d %H:%M:%S %Y %z")
 
 
-def gen_commit_txt(commit_id, message, second_parent_for_merge=None):
+def gen_commit_txt(commit_id, message, second_parent_for_merge=None, wit_root=None):
+    if wit_root is None:
+        wit_root = find_wit()
     timestamp = gen_timestamp()
     parent = None
-    ref = read_references()
+    ref = read_references(wit_root)
     if ref:
         parent = ref['HEAD']
     if second_parent_for_merge is not None:
@@ -560,84 +821,358 @@ def gen_commit_txt(commit_id, message, second_parent_for_merge=None):
         f'date={timestamp}\n'
         f'message={message}'
     )
-    with open(Path('.wit', 'images', f'{commit_id}.txt'), 'w') as fh:
+    with open(Path(wit_root, '.wit', 'images', f'{commit_id}.txt'), 'w') as fh:
         fh.write(content)
 
 
-def read_references():
-    return txt_to_dict(Path('.wit', 'references.txt'))
+class RefStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.load()
 
+    def load(self):
+        self.refs = txt_to_dict(self.path)
+        self.mtime_ns = self._stat_mtime()
+        self.dirty = False
 
-def edit_references(ref_name, ref_id):
-    ref = read_references()
-    ref[ref_name] = ref_id
-    content = ''
-    for r_name, r_id in ref.items():
-        line = f'{r_name}={r_id}\n'
-        content += line
-    with open(Path('.wit', 'references.txt'), 'r+') as fh:
-        fh.write(content)
+    def _stat_mtime(self):
+        try:
+            return self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        # Pick up writes made by another process, unless we have our own
+        # unflushed edits.
+        if not self.dirty and self._stat_mtime() != self.mtime_ns:
+            self.load()
+
+    def set(self, ref_name, ref_id):
+        if self.refs.get(ref_name) == ref_id:
+            return
+        self.refs[ref_name] = ref_id
+        self.dirty = True
+
+    def flush(self):
+        if not self.dirty:
+            return
+        content = ''.join(f'{r_name}={r_id}\n' for r_name, r_id in self.refs.items())
+        self.path.write_text(content, newline='\n')
+        self.mtime_ns = self._stat_mtime()
+        self.dirty = False
+
+
+_refs_cache = {}
+
+
+def get_ref_store(wit_root=None):
+    if wit_root is None:
+        wit_root = find_wit()
+    key = str(wit_root)
+    if key not in _refs_cache:
+        _refs_cache[key] = RefStore(Path(wit_root, '.wit', 'references.txt'))
+    else:
+        _refs_cache[key].refresh()
+    return _refs_cache[key]
 
 
-def gen_references(commit_id):
-    ref = read_references()
-    active_branch = get_activated_branch()
+def read_references(wit_root=None):
+    return get_ref_store(wit_root).refs
+
+
+def edit_references(ref_name, ref_id, wit_root=None):
+    get_ref_store(wit_root).set(ref_name, ref_id)
+
+
+def flush_refs(wit_root=None):
+    get_ref_store(wit_root).flush()
+
+
+def gen_references(commit_id, wit_root=None):
+    if wit_root is None:
+        wit_root = find_wit()
+    ref = read_references(wit_root)
+    active_branch = get_activated_branch(wit_root)
     head_id = commit_id
     if ref:
         curr_head_id = ref['HEAD']
         active_id = ref[active_branch]
         if curr_head_id == active_id:
             active_id = commit_id
-        edit_references('HEAD', head_id)
-        edit_references(active_branch, active_id)
+        edit_references('HEAD', head_id, wit_root)
+        edit_references(active_branch, active_id, wit_root)
     else:
-        content = (
-            f'HEAD={head_id}\n'
-            f'{active_branch}={commit_id}\n'
-        )
-        with open(Path('.wit', 'references.txt'), 'w') as fh:
-            fh.write(content)
+        edit_references('HEAD', head_id, wit_root)
+        edit_references(active_branch, commit_id, wit_root)
 
 
 def gen_hash():
-    h = ''.join(random.choices(string.ascii_letters[:6] + string.digits, k=40))
-
-    return h
+    return secrets.token_hex(20)
 
 
-def get_changes(dcmp, left_only=False, right_only=False, diff=True):
-    if diff:
-        for name in dcmp.diff_files:
-            yield name
-    if left_only:
-        for name in dcmp.left_only:
-            yield name
-    if right_only:
-        for name in dcmp.right_only:
-            yield name
+HASH_CACHE_FILE = 'hashcache.pkl'
+HASH_CACHE_VERSION = 2
 
-    for sub_dcmp in dcmp.subdirs.values():
-        yield from get_changes(sub_dcmp, left_only, right_only, diff)
 
-
-def get_changes_to_be_committed(wit_root, last_commit_id):
-    staging_area = Path(wit_root, '.wit', 'staging_area')
-    last_commit_folder = Path(wit_root,
-                              '.wit', 'images', last_commit_id)
-    dcmp = dircmp(staging_area, last_commit_folder, ignore=['.wit'])
-    return list(get_changes(dcmp, left_only=True, right_only=False, diff=True))
+@lru_cache(maxsize=None)
+def load_index(wit_root_str):
+    index_path = Path(wit_root_str, '.wit', HASH_CACHE_FILE)
+    try:
+        with open(index_path, 'rb') as fh:
+            version, index = pickle.load(fh)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError,
+            TypeError, ValueError):
+        return {}
+    if version != HASH_CACHE_VERSION or not isinstance(index, dict):
+        return {}
+    return index
+
+
+_dirty_indexes = set()
+
+
+def save_index(wit_root):
+    wit_root_str = str(wit_root)
+    if wit_root_str not in _dirty_indexes:
+        return
+    index = load_index(wit_root_str)
+    prune_index(index)
+    with open(Path(wit_root_str, '.wit', HASH_CACHE_FILE), 'wb') as fh:
+        pickle.dump((HASH_CACHE_VERSION, index), fh)
+    _dirty_indexes.discard(wit_root_str)
+
+
+def prune_index(index):
+    # Drops entries whose file was deleted, replaced or modified since it was
+    # hashed, so the cache tracks the repository instead of growing forever.
+    for key, (path, signature, _file_hash) in list(index.items()):
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            del index[key]
+            continue
+        if (file_key(path, file_stat) != key
+                or (file_stat.st_size, file_stat.st_mtime_ns) != signature):
+            del index[key]
+
+
+def file_key(path, file_stat):
+    # DirEntry.stat() leaves st_ino and st_dev at 0 on Windows, where
+    # os.stat() fills them in. None means the file can't be cached.
+    if not file_stat.st_ino:
+        file_stat = os.stat(path)
+    if not file_stat.st_ino:
+        return None
+    return (file_stat.st_dev, file_stat.st_ino)
+
+
+def lookup_file_hash(wit_root, path, file_stat):
+    # The cache maps (st_dev, st_ino) -> (path, (size, mtime_ns), blake2b) so
+    # unchanged files are never re-read across invocations.
+    key = file_key(path, file_stat)
+    if key is None:
+        return None
+    signature = (file_stat.st_size, file_stat.st_mtime_ns)
+    cached = load_index(str(wit_root)).get(key)
+    if cached is not None and cached[1] == signature:
+        return cached[2]
+    return None
 
 
-def get_changes_not_staged(wit_root):
+def get_file_hash(wit_root, path, file_stat):
+    cached = lookup_file_hash(wit_root, path, file_stat)
+    if cached is not None:
+        return cached
+    file_hash = hashlib.blake2b(Path(path).read_bytes(), digest_size=20).digest()
+    key = file_key(path, file_stat)
+    if key is not None:
+        signature = (file_stat.st_size, file_stat.st_mtime_ns)
+        load_index(str(wit_root))[key] = (os.fspath(path), signature, file_hash)
+        _dirty_indexes.add(str(wit_root))
+    return file_hash
+
+
+def build_tree_hash(wit_root, path, memo=None):
+    # Files contribute their cached content hash when there is one and their
+    # (size, mtime) otherwise, so building a tree hash only stats files.
+    # Equal trees still hash equal; a tree that merely looks different is
+    # compared file by file in diff_trees.
+    path = os.fspath(path)
+    if memo is None:
+        memo = {}
+    if path in memo:
+        return memo[path]
+    tree_hash = hashlib.sha1()
+    for name, entry in sorted(_scan(path).items()):
+        if entry.is_dir():
+            mode = S_IFDIR
+            child_hash = build_tree_hash(wit_root, entry.path, memo)
+        else:
+            child_stat = entry.stat()
+            mode = S_IFMT(child_stat.st_mode)
+            child_hash = lookup_file_hash(wit_root, entry.path, child_stat)
+            if child_hash is None:
+                child_hash = (f'{child_stat.st_size}\0'
+                              f'{child_stat.st_mtime_ns}').encode()
+        tree_hash.update(f'{name}\0{mode:o}\0{len(child_hash)}\0'.encode())
+        tree_hash.update(child_hash)
+    memo[path] = tree_hash.digest()
+    return memo[path]
+
+
+def stats_differ(wit_root, path_a, stat_a, path_b, stat_b):
+    # Different sizes always differ, and the same inode (a hard-linked
+    # snapshot) or identical (size, mtime) are taken as equal; only the
+    # remaining files are hashed. DirEntry.stat() reports st_ino as 0 on
+    # Windows, so the inode check needs a real one.
+    if stat_a.st_size != stat_b.st_size:
+        return True
+    if (stat_a.st_ino
+            and (stat_a.st_dev, stat_a.st_ino) == (stat_b.st_dev, stat_b.st_ino)):
+        return False
+    if stat_a.st_mtime_ns == stat_b.st_mtime_ns:
+        return False
+    return (get_file_hash(wit_root, path_a, stat_a)
+            != get_file_hash(wit_root, path_b, stat_b))
+
+
+def diff_trees(wit_root, left, right, left_only=False, right_only=False,
+               diff=True, memo=None):
+    if memo is None:
+        memo = {}
+    stack = [(os.fspath(left), os.fspath(right))]
+    while stack:
+        left, right = stack.pop()
+        if build_tree_hash(wit_root, left, memo) == build_tree_hash(wit_root, right, memo):
+            continue
+
+        left_entries = _scan(left)
+        right_entries = _scan(right)
+        common_files = []
+        common_dirs = []
+        for name in sorted(left_entries.keys() & right_entries.keys()):
+            left_entry, right_entry = left_entries[name], right_entries[name]
+            left_is_dir, right_is_dir = left_entry.is_dir(), right_entry.is_dir()
+            if left_is_dir and right_is_dir:
+                common_dirs.append((left_entry.path, right_entry.path))
+            elif not (left_is_dir or right_is_dir):
+                common_files.append((name, left_entry, right_entry))
+
+        if diff:
+            for name, left_entry, right_entry in common_files:
+                if entries_differ(wit_root, left_entry, right_entry):
+                    yield name
+        if left_only:
+            yield from sorted(left_entries.keys() - right_entries.keys())
+        if right_only:
+            yield from sorted(right_entries.keys() - left_entries.keys())
+
+        # Reversed so subdirectories are popped in name order.
+        stack.extend(reversed(common_dirs))
+
+
+def _scan(path):
+    if path is None:
+        return None
+    with os.scandir(path) as it:
+        return {entry.name: entry for entry in it if entry.name != '.wit'}
+
+
+def walk_three(wd, staging, head):
+    # Yields (rel_path, wd_entry, staging_entry, head_entry) for every name in
+    # the three trees. An entry is a DirEntry when present, False when its
+    # directory was scanned but lacks the name, and None when that tree
+    # doesn't have the directory at all.
+    stack = [('', (wd, staging, head))]
+    while stack:
+        rel_path, roots = stack.pop()
+        scans = [_scan(root) for root in roots]
+        names = sorted(set().union(*(scan for scan in scans if scan is not None)))
+        subdirs = []
+        for name in names:
+            entries = [None if scan is None else scan.get(name, False)
+                       for scan in scans]
+            child_rel_path = os.path.join(rel_path, name)
+            yield (child_rel_path, *entries)
+            is_dir = [bool(entry) and entry.is_dir() for entry in entries]
+            if (is_dir[0] and is_dir[1]) or (is_dir[1] and is_dir[2]):
+                sub_roots = tuple(entry.path if entry_is_dir else None
+                                  for entry, entry_is_dir in zip(entries, is_dir))
+                subdirs.append((child_rel_path, sub_roots))
+        # Reversed so subdirectories are popped in name order.
+        stack.extend(reversed(subdirs))
+
+
+def entries_differ(wit_root, entry_a, entry_b):
+    if entry_a.is_dir() or entry_b.is_dir():
+        return False
+    return stats_differ(wit_root, entry_a.path, entry_a.stat(),
+                        entry_b.path, entry_b.stat())
+
+
+def is_change_to_be_committed(wit_root, row):
+    _rel_path, _wd_entry, staging_entry, head_entry = row
+    if not staging_entry or head_entry is None:
+        return False
+    return head_entry is False or entries_differ(wit_root, staging_entry, head_entry)
+
+
+def is_change_not_staged(wit_root, row):
+    _rel_path, wd_entry, staging_entry, _head_entry = row
+    return bool(wd_entry and staging_entry
+                and entries_differ(wit_root, wd_entry, staging_entry))
+
+
+def is_untracked(row):
+    _rel_path, wd_entry, staging_entry, _head_entry = row
+    return bool(wd_entry) and staging_entry is False
+
+
+def filter_changes_to_be_committed(wit_root, walk):
+    for row in walk:
+        if is_change_to_be_committed(wit_root, row):
+            yield os.path.basename(row[0])
+
+
+def filter_changes_not_staged(wit_root, walk):
+    for row in walk:
+        if is_change_not_staged(wit_root, row):
+            yield os.path.basename(row[0])
+
+
+def filter_untracked(walk):
+    for row in walk:
+        if is_untracked(row):
+            yield os.path.basename(row[0])
+
+
+def get_untracked_if_clean(wit_root, last_commit_id):
+    # Returns None at the first staged or unstaged change instead of
+    # finishing the walk; otherwise the untracked names.
     staging_area = Path(wit_root, '.wit', 'staging_area')
-    dcmp = dircmp(wit_root, staging_area, ignore=['.wit'])
-    return list(get_changes(dcmp, left_only=False, right_only=False, diff=True))
+    last_commit_folder = Path(wit_root, '.wit', 'images', last_commit_id)
+    untracked = []
+    try:
+        for row in walk_three(os.fspath(wit_root), os.fspath(staging_area),
+                              os.fspath(last_commit_folder)):
+            if (is_change_to_be_committed(wit_root, row)
+                    or is_change_not_staged(wit_root, row)):
+                return None
+            if is_untracked(row):
+                untracked.append(os.path.basename(row[0]))
+    finally:
+        save_index(wit_root)
+    return untracked
 
 
-def get_untracked(wit_root):
+def get_changes_to_be_committed(wit_root, last_commit_id):
     staging_area = Path(wit_root, '.wit', 'staging_area')
-    dcmp = dircmp(wit_root, staging_area, ignore=['.wit'])
-    return list(get_changes(dcmp, left_only=True, diff=False))
+    last_commit_folder = Path(wit_root,
+                              '.wit', 'images', last_commit_id)
+    walk = walk_three(None, os.fspath(staging_area), os.fspath(last_commit_folder))
+    changes = list(filter_changes_to_be_committed(wit_root, walk))
+    save_index(wit_root)
+    return changes
 
 
 if __name__ == "__main__":
@@ -651,6 +1186,7 @@ if __name__ == "__main__":
         UnableToCheckoutError,
         NoPreviousCommitsError,
         BranchExistsError,
+        InvalidBranchNameError,
         InvalidMergeError,
         NoChangesSinceLastCommitError,
         UnsuitableDiffArgumentError